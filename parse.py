@@ -1,42 +1,65 @@
+import re
+import mmap
 import numpy as np
 
-def parse_tecplot(filename, startpos = 0):
+# quoted variable names in the header; compiled so it can be searched over a slice of the file
+QUOTED_RE = re.compile(rb'"([^"]*)"')
+
+# coordinate variables placed at the start of the cell-centered data, ahead of the variables read from file
+CELL_COORDS = ["z(m)", "r(m)"]
+
+# characters that can appear in a tecplot value that is exactly zero
+ZERO_CHARS = b"0.+-eE \t\r\n"
+
+def map_file(filename):
     """
-    Parse a tecplot file from Hall2De, extracting nodal and cell-centered data
+    Memory-map a tecplot file for reading
     """
-    # read file and skip first line containing "title"
-    f = open(filename, "rb")
-    if (startpos == 0):
-        line = f.readline()
+    with open(filename, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    def strip_brackets(s, l, r = None):
+def parse_tecplot(buf, startpos = 0, mesh = None):
+    """
+    Parse a tecplot file from Hall2De, extracting nodal and cell-centered data.
+    buf is the memory-mapped file and startpos the offset of the frame's TITLE line.
+    If the mesh from a previous frame is passed in, the cell connectivity is not re-read
+    """
+    # the header holds the quoted variable names, between the TITLE line and the ZONE line
+    header_start = buf.find(b"\n", startpos) + 1
+    zone_start = buf.find(b"\nZONE", startpos) + 1
+    zone_end = buf.find(b"\n", zone_start) + 1
+    variables = [v.decode("utf-8") for v in QUOTED_RE.findall(buf, header_start, zone_start)]
+    zone_line = buf[zone_start:zone_end].decode("utf-8")
+
+    # the frame runs until the next TITLE line (movie files) or the end of the file
+    endpos = buf.find(b"\nTITLE", startpos)
+    if endpos == -1:
+        nextframe_pos = -1
+        endpos = len(buf)
+    else:
+        endpos += 1
+        nextframe_pos = endpos
+
+    # find the end of every data line in this frame in one pass
+    frame = np.frombuffer(buf, dtype=np.uint8, count=endpos-zone_end, offset=zone_end)
+    line_ends = np.flatnonzero(frame == ord("\n")) + zone_end + 1
+    if endpos > zone_end and frame[-1] != ord("\n"):
+        line_ends = np.append(line_ends, endpos)
+    del frame
+
+    pos = zone_end
+    next_line = 0
+    def read_lines(n):
         """
-        for a string of the form str = "this is a {string}!"
-        return "string" is strip_brackets(str, '{', '}')
+        return the next n lines of the frame as a single bytes object
         """
-        if r is None:
-            r = l
-        inside = False
-        acc = ""
-        for c in s:
-            if inside:
-                if c == r:
-                    break
-                acc += c;
-            else:
-                if c == l:
-                    inside = True
-        return acc
-
-    # read variables
-    variables = []
-    line = f.readline().decode("utf-8")
-    while not line.startswith("ZONE"):
-        variables.append(strip_brackets(line, '"'))
-        line = f.readline().decode("utf-8")
+        nonlocal pos, next_line
+        start, pos = pos, line_ends[next_line + n - 1]
+        next_line += n
+        return buf[start:pos]
 
     # strip ZONE off of zone line and parse info
-    _, zoneinfo_str = line.split(" ", 1)
+    _, zoneinfo_str = zone_line.split(" ", 1)
     zoneinfo = {}
     for field in (s.strip() for s in zoneinfo_str.split(",")):
         key, value = field.split("=", 1)
@@ -45,140 +68,188 @@ def parse_tecplot(filename, startpos = 0):
     # get info from zone dict - num nodes and cell-centered locations
     num_nodes = int(zoneinfo["N"])
     cell_lo, cell_hi = map(int,
-        strip_brackets(
-            strip_brackets(zoneinfo["VARLOCATION"], "(", ")").split("=")[0],
-            "[", "]").split("-")
+        re.search(r"\[(\d+)-(\d+)\]", zoneinfo["VARLOCATION"]).groups()
     )
 
     num_nodal = cell_lo - 1
     num_cellcentered = len(variables) - num_nodal
 
-    def read_data(n):   
-        data = np.zeros(n)
-        for i in range(n):
-            data[i] = float(f.readline().strip())
+    def read_data(n):
+        block = read_lines(n)
+
+        # all-zero columns are common, so look for them in the raw text before parsing:
+        # if nothing is left once zeros, signs, exponent markers and whitespace are removed,
+        # the column is all zero. peek at the start first so nonzero columns skip the full scan
+        if not block[:1024].translate(None, ZERO_CHARS) and not block.translate(None, ZERO_CHARS):
+            return None
 
-        if np.any(data):
+        # let numpy parse the whole block in one go
+        data = np.fromstring(block, sep=" ", count=n)
+
+        if data.any():
             return data
     
-    # read nodal data, omitting columns that are empty/all zero
-    nodal_data = {}
-    for i in range(num_nodal):
-        data = read_data(num_nodes)
-        if data is not None:
-            nodal_data[variables[i]] = data
-
-    # record position - next line will be start of cell-centered data
-    cell_pos = f.tell()
-
-    # jump ahead to cell connectivity info and read it
-    nextframe_pos = -1
-    cells = []
-    for line in f:
-        if line.decode("utf-8").startswith("TITLE"):
-            # this is a movie file, the next frame starts here
-            nextframe_pos = f.tell()
-            break
-        spl = line.strip().split()
-        if len(spl) == 1:
-            continue
-        cells.append(np.array([int(s) for s in spl]))
-
-    num_cells = len(cells)
-    cells = np.array(cells)
-
-    # return to start of cell-centered data
-    f.seek(cell_pos)
-
-    # read cell-centered data
-    cell_data = {}
-    for i in range(cell_lo-1, cell_hi):
-        data = read_data(num_cells)
-        if data is not None:
-            cell_data[variables[i]] = data
+    def read_block(names, n, mat):
+        """
+        read a column of n values for each variable in names into consecutive rows of mat,
+        omitting columns that are empty/all zero. returns the names of the rows that were filled
+        """
+        kept = []
+        for name in names:
+            data = read_data(n)
+            if data is not None:
+                mat[len(kept)] = data
+                kept.append(name)
+        return kept
+
+    # read nodal data into one (num_vars, num_nodes) matrix
+    nodal_mat = np.empty((num_nodal, num_nodes))
+    nodal_names = read_block(variables[:num_nodal], num_nodes, nodal_mat)
+    nodal_mat = nodal_mat[:len(nodal_names)]
+
+    # read cell-centered data, leaving the first rows for the cell-centered coords
+    num_cells = int(zoneinfo["E"])
+    num_coords = len(CELL_COORDS)
+    cell_mat = np.empty((num_coords + cell_hi - cell_lo + 1, num_cells))
+    cell_names = CELL_COORDS + read_block(variables[cell_lo-1:cell_hi], num_cells, cell_mat[num_coords:])
+    cell_mat = cell_mat[:len(cell_names)]
+
+    if mesh is None:
+        # cell connectivity info follows the cell-centered data, one cell per line
+        cells = np.fromstring(read_lines(num_cells), dtype=np.int32, sep=" ").reshape(num_cells, -1)
+        coords = nodal_mat[[nodal_names.index(name) for name in CELL_COORDS]]
+        mesh = build_mesh(coords, cells[:, :4] - 1)
 
     # get cell-centered coords
-    # NOTE: this is not a true centroid, but is good enough for now
-    z = nodal_data["z(m)"]
-    r = nodal_data["r(m)"]
+    _, cell_mat[:num_coords], _ = mesh
 
-    z_c = np.zeros(num_cells)
-    r_c = np.zeros(num_cells)
+    return nodal_names, nodal_mat, cell_names, cell_mat, mesh, nextframe_pos
 
-    for i in range(4):
-        inds = cells[:, i] - 1
-        cell_data[f"i{i}"] = inds
-        z_c += 0.25 * z[inds]
-        r_c += 0.25 * r[inds]
+def build_mesh(coords, inds):
+    """
+    Compute cell centers and node-to-cell interpolation weights from the nodal coords (one row per
+    entry of CELL_COORDS) and the (zero-based) cell connectivity. These only depend on the mesh, so
+    the same mesh can be reused for every frame of a movie file. Returns (inds, centers, wts)
+    """
+    # gather the four vertices of every cell at once
+    # NOTE: this is not a true centroid, but is good enough for now
+    vertices = coords[:, inds]
+    centers = vertices.mean(axis=2)
 
-    cell_data["z(m)"] = z_c
-    cell_data["r(m)"] = r_c
-    
-    # reorder cell vars so geometry starts first
-    cell_vars = ["z(m)", "r(m)", "i0", "i1", "i2", "i3"]
-    cell_vars += list(cell_data.keys())[6:]
-    cell_data = {k: cell_data[k] for k in cell_vars}
+    # compute interpolation weights (inverse squared distance), one row per cell
+    wts = 1 / ((vertices - centers[:, :, None])**2).sum(axis=0)
+    wts /= wts.sum(axis=1, keepdims=True)
 
-    f.close()
-    return nodal_data, cell_data, nextframe_pos
+    return inds, centers, wts
 
-def interp_to_cells(nodal_data, cell_data):
+def interp_to_cells(nodal_names, nodal_mat, cell_names, cell_mat, mesh, dtype = np.float64):
     """
-    Interpolate all nodal variables to cell centers, insert into cell-centered data dictionary
+    Interpolate all nodal variables to cell centers, returning the interpolated variable names
+    and a (num_vars, num_cells) matrix with the cell-centered variables appended.
+    Only the nodal gather and weighted sum run in the given dtype; the coords and the
+    returned matrix stay in float64
     """
-    inds = [cell_data[f"i{i}"] for i in range(4)]
-    
-    zc = cell_data["z(m)"]
-    rc = cell_data["r(m)"]
-    
-    # compute interpolation weights
-    dzs = [(nodal_data["z(m)"][i] - zc)**2 for i in inds]
-    drs = [(nodal_data["r(m)"][i] - rc)**2 for i in inds]
-    wts = [1 / (dz + dr) for (dz, dr) in zip (dzs, drs)]
-    sumwt = sum(wts)
-    wts = np.array([w / sumwt for w in wts])
+    inds, _, wts = mesh
+
+    # nodal vars first, then the cell-centered vars read from file (skipping the coords)
+    num_nodal = len(nodal_names)
+    num_coords = len(CELL_COORDS)
+    itp_names = nodal_names + cell_names[num_coords:]
+    itp_mat = np.empty((len(itp_names), len(inds)))
+
+    # interpolate all nodal vars to cell centers, one vertex at a time, gathering into
+    # preallocated arrays rather than building a (num_vars, num_cells, 4) temporary
+    values = nodal_mat.astype(dtype, copy=False)
+    wts_d = wts.astype(dtype, copy=False)
+    if values.dtype == itp_mat.dtype:
+        out = itp_mat[:num_nodal]
+    else:
+        out = np.empty((num_nodal, len(inds)), dtype=dtype)
+    tmp = np.empty_like(out)
+    np.take(values, inds[:, 0], axis=1, out=out)
+    out *= wts_d[:, 0]
+    for i in range(1, 4):
+        np.take(values, inds[:, i], axis=1, out=tmp)
+        tmp *= wts_d[:, i]
+        out += tmp
+    if out.dtype != itp_mat.dtype:
+        itp_mat[:num_nodal] = out
+
+        # redo the coords in float64 so cell positions don't lose precision
+        for name in CELL_COORDS:
+            k = nodal_names.index(name)
+            itp_mat[k] = (nodal_mat[k][inds] * wts).sum(axis=1)
+
+    # add cell-centered vars at end, at full precision
+    itp_mat[num_nodal:] = cell_mat[num_coords:]
+
+    return itp_names, itp_mat
 
-    # create new dict 
-    itp = {"z(m)": zc, "r(m)": rc}
+import os
+from datetime import datetime
 
-    # interpolate nodal vars to cell centers
-    for k in nodal_data.keys():
-        v0, v1, v2, v3 = [nodal_data[k][i] for i in inds]
-        itp[k] = wts[0]*v0 + wts[1]*v1 + wts[2]*v2 + wts[3]*v3 
+def write_rows(f, data, dlm = "\t", fmt = "%.18e", chunk_rows = 4096):
+    """
+    Write the rows of a 2D array to an open text file, formatting chunk_rows rows per call
+    so that memory use stays bounded for large outputs
+    """
+    nrows, ncols = data.shape
+    row_fmt = dlm.join([fmt] * ncols) + "\n"
+    chunk_fmt = row_fmt * chunk_rows
+    for start in range(0, nrows, chunk_rows):
+        chunk = data[start:start+chunk_rows]
+        if len(chunk) < chunk_rows:
+            chunk_fmt = row_fmt * len(chunk)
+        f.write(chunk_fmt % tuple(chunk.ravel().tolist()))
+
+# descriptions of each kind of data that can be extracted, used in the output header
+DATA_KINDS = {
+    "interpolated": "(all variables, interpolated to cell centers)",
+    "nodal": "(nodal variables only)",
+    "cellcentered": "(cell-centered variables only)",
+}
+
+def check_kind(kind):
+    """
+    Raise an exception if kind is not one of DATA_KINDS
+    """
+    if kind not in DATA_KINDS:
+        raise Exception(f"Invalid kind '{kind}'. Select either 'nodal', 'cellcentered', or 'interpolated'")
 
-    # add cell-centered vars at end
-    for (i, k) in enumerate(cell_data.keys()):
-        # don't re-add z, r, or indices
-        if (i >= 6):
-            itp[k] = cell_data[k]
+def extract_to_txt(tecfile, frame = 0, start_pos = 0, kind = "interpolated", dlm = "\t", outfile = "output.txt", params = None, buf = None, mesh = None, dtype = np.float64):
+    # check kind before doing any parsing
+    check_kind(kind)
 
-    return itp
+    if buf is None:
+        buf = map_file(tecfile)
+    parsed = parse_tecplot(buf, start_pos, mesh)
+    write_txt(tecfile, parsed, frame, kind, dlm, outfile, params, dtype)
 
-import os
-from datetime import datetime
+    # return the offset of the next frame
+    return parsed[-1]
+
+def write_txt(tecfile, parsed, frame = 0, kind = "interpolated", dlm = "\t", outfile = "output.txt", params = None, dtype = np.float64):
+    """
+    Select the requested kind of data from the result of parse_tecplot and write it to outfile,
+    with a header describing where it came from
+    """
+    check_kind(kind)
+    nodal_names, nodal_mat, cell_names, cell_mat, mesh, nextframe_pos = parsed
 
-def extract_to_txt(tecfile, frame = 0, start_pos = 0, kind = "interpolated", dlm = "\t", outfile = "output.txt", params = None):
-    nodal, cellcentered, nextframe_pos = parse_tecplot(tecfile, start_pos)
+    # only the selected dataset is computed
+    if kind == "interpolated":
+        names, mat = interp_to_cells(nodal_names, nodal_mat, cell_names, cell_mat, mesh, dtype)
+    elif kind == "nodal":
+        names, mat = nodal_names, nodal_mat
+    else:
+        names, mat = cell_names, cell_mat
 
     now = datetime.now()
     dt_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
     header = f"# original file: {os.path.abspath(tecfile)}\n" 
     header += f"# date generated: {dt_str}\n"
-    header += f"# data kind: {kind} "
-
-    if kind == "interpolated":
-        interp = interp_to_cells(nodal, cellcentered)
-        dataset = interp
-        header += "(all variables, interpolated to cell centers)\n"
-    elif kind == "nodal":
-        dataset = nodal
-        header += "(nodal variables only)\n"
-    elif kind == "cellcentered":
-        dataset = cellcentered
-        header += "(cell-centered variables only)\n"
-    else:
-        raise Exception("Invalid kind '{kind}'. Select either 'nodal', 'cellcentered', or 'interpolated'")
+    header += f"# data kind: {kind} {DATA_KINDS[kind]}\n"
 
     # write metadata
     if params is not None:
@@ -187,28 +258,77 @@ def extract_to_txt(tecfile, frame = 0, start_pos = 0, kind = "interpolated", dlm
             header += f"# {k}: {params[k]}\n"
     
     # write column headers
-    header = header + dlm.join('"' + var + '"' for var in interp.keys())
+    header = header + dlm.join('"' + var + '"' for var in names)
 
     # write data
-    data = np.array(list(interp.values())).T
     if frame > 0 or nextframe_pos != -1:
         body, ext = os.path.splitext(outfile)
         outfile = body + f"_{frame:06d}" + ext
 
     print(outfile)
-    np.savetxt(outfile, data, header=header, delimiter = dlm, comments='')
-    return nextframe_pos
+    with open(outfile, "w") as f:
+        f.write(header + "\n")
+        write_rows(f, mat.T, dlm)
+
+def find_frames(buf):
+    """
+    Return the offsets of the TITLE lines that start each frame of a (possibly movie) tecplot file
+    """
+    offsets = [0]
+    pos = buf.find(b"\nTITLE")
+    while pos != -1:
+        offsets.append(pos + 1)
+        pos = buf.find(b"\nTITLE", pos + 1)
+    return offsets
+
+# per-process state for extracting frames in parallel, set by init_worker
+worker_state = {}
+
+def init_worker(tecfile, kwargs):
+    """
+    Map the tecfile once per worker. kwargs are passed on to extract_to_txt for every frame
+    """
+    worker_state["tecfile"] = tecfile
+    worker_state["buf"] = map_file(tecfile)
+    worker_state["kwargs"] = kwargs
+
+def extract_frame(args):
+    """
+    Extract a single frame in a worker process. args is (frame, start_pos)
+    """
+    frame, start_pos = args
+    extract_to_txt(
+        worker_state["tecfile"], frame = frame, start_pos = start_pos, buf = worker_state["buf"],
+        **worker_state["kwargs"]
+    )
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) == 1:
+    from multiprocessing import Pool
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) == 0:
         quit(1)
 
-    nextframe_pos = 0
-    frame = 0
+    tecfile = args[0]
+    outfile = "output/output.txt"
+
+    # --fp32 interpolates in single precision, which is enough for the ~8 digits Hall2De writes
+    dtype = np.float32 if "--fp32" in sys.argv else np.float64
     os.makedirs("output")
-    while True:
-        nextframe_pos = extract_to_txt(sys.argv[1], start_pos = nextframe_pos, frame = frame, outfile = "output/output.txt")
-        if nextframe_pos == -1:
-            break
-        frame += 1
+
+    # frame boundaries are found up front so that frames can be extracted independently
+    buf = map_file(tecfile)
+    frames = find_frames(buf)
+
+    # the mesh is the same for every frame, so the first frame's mesh is shared with the rest
+    parsed = parse_tecplot(buf, frames[0])
+    mesh = parsed[4]
+    write_txt(tecfile, parsed, outfile = outfile, dtype = dtype)
+    buf.close()
+
+    # extract the remaining frames of a movie file in parallel
+    if len(frames) > 1:
+        num_workers = min(os.cpu_count() or 1, len(frames) - 1)
+        with Pool(num_workers, initializer = init_worker, initargs = (tecfile, dict(outfile = outfile, mesh = mesh, dtype = dtype))) as pool:
+            for _ in pool.imap_unordered(extract_frame, enumerate(frames[1:], 1)):
+                pass